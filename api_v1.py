@@ -1,77 +1,148 @@
 import asyncio
+from concurrent.futures import Executor
 from datetime import datetime
-from io import BytesIO
-from pathlib import Path
-from typing import Optional, BinaryIO
-from urllib.parse import urljoin
+from functools import partial
+import re
+from types import SimpleNamespace
+from typing import Optional, BinaryIO, Literal, Union
 
 from picamera import PiCamera, PiCameraAlreadyRecording
 from aiohttp import web
+import msgspec
+from msgspec import Meta
+import orjson
+from typing_extensions import Annotated
 
 from session import SessionAlreadyExists, SessionNotExists, SessionManager
-from util import MediaUploader, MediaContainer
+from util import (LiveContainerizer, MediaUploader, MediaContainer, MP4_STREAMING_OPTIONS, TIMESTAMP_FORMAT,
+                  preallocated_stream)
 
+# 'YYYYmmddHHMMSS'
+_ENTRY_DATETIME = re.compile(r'[0-9]{14}')
+_EXPOSURE_MODES = frozenset(PiCamera.EXPOSURE_MODES)
 
-async def capture_image(cam: PiCamera, delay: float, image_format='jpeg') -> BinaryIO:
-    """Capture an image"""
+
+class CaptureParams(msgspec.Struct):
+    """Request body of POST /camera"""
+    uid: int
+    entry_datetime: Union[str, int]
+    delay: Optional[float] = None
+    timeout: Optional[float] = None
+    mode: Literal['image', 'video'] = 'video'
+
+
+class CameraSettings(msgspec.Struct):
+    """Request body of PUT /camera/settings"""
+    width: Annotated[int, Meta(ge=640, le=3280)]
+    height: Annotated[int, Meta(ge=480, le=2464)]
+    framerate: Annotated[float, Meta(ge=0, le=90)]
+    rotation: Literal[0, 90, 180, 270]
+    # Checked against PiCamera.EXPOSURE_MODES after decoding
+    exposure_mode: str
+
+
+async def capture_image(cam: PiCamera, executor: Executor, settings: dict, delay: float,
+                        image_format='jpeg') -> BinaryIO:
+    """Capture an image on the camera executor"""
     # Insert a delay before taking an image
     if delay > 0:
         await asyncio.sleep(delay)
 
-    # Trigger a shutter
-    stream = BytesIO()
-    cam.capture(stream, image_format, use_video_port=True)
+    # Trigger a shutter. One byte per pixel is a generous upper bound for a JPEG.
+    stream = preallocated_stream(settings['width'] * settings['height'])
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(executor, partial(cam.capture, stream, image_format, use_video_port=True))
+    stream.truncate(stream.tell())
     stream.seek(0)
 
     return stream
 
 
-async def capture_video(cam: PiCamera, delay: float, timeout: float, video_format='h264', **kwargs) -> BinaryIO:
-    """Capture a video"""
-    # Insert a delay before recording
-    if delay > 0:
-        await asyncio.sleep(delay)
+async def capture_video(cam: PiCamera, executor: Executor, settings: dict, delay: float, timeout: float,
+                        video_format='h264', **kwargs) -> BinaryIO:
+    """Capture a video on the camera executor, containerized into MP4 while recording"""
+    # Spawn ffmpeg first, so that its startup overlaps the delay. Its output is buffered
+    # for the expected bitrate plus some headroom, up to a cap.
+    expected_size = int(kwargs.get('bitrate', 17000000) * timeout / 8) + 64 * 1024
+    output = await LiveContainerizer.open(settings['framerate'], 'mp4', MP4_STREAMING_OPTIONS, video_format,
+                                          expected_size)
+    loop = asyncio.get_running_loop()
+    try:
+        # Insert a delay before recording
+        if delay > 0:
+            await asyncio.sleep(delay)
 
-    # Start recording
-    raw_stream = BytesIO()
-    cam.start_recording(raw_stream, video_format, **kwargs)
-    cam.wait_recording(0)
-    await asyncio.sleep(timeout)
-    cam.stop_recording()
-    raw_stream.seek(0)
+        # Start recording straight into ffmpeg
+        await loop.run_in_executor(executor, partial(cam.start_recording, output, video_format, **kwargs))
+        await loop.run_in_executor(executor, cam.wait_recording, 0)
+        await asyncio.sleep(timeout)
+        await loop.run_in_executor(executor, cam.stop_recording)
+    finally:
+        video = await output.close()
 
-    return raw_stream
+    return video
 
 
-async def capture_image_and_upload(cam: PiCamera, delay: float,
-                                   uploader: MediaUploader, upload_path: Path, timestamp: datetime):
+async def capture_image_and_upload(cam: PiCamera, executor: Executor, settings: dict, delay: float,
+                                   uploader: MediaUploader, upload_path: str, timestamp: datetime,
+                                   timestamp_str: str):
     """Capture an image and upload"""
-    stream = await capture_image(cam, delay, 'jpeg')
-    uploader.put(upload_path, MediaContainer(stream, 'image/jpeg', timestamp))
+    stream = await capture_image(cam, executor, settings, delay, 'jpeg')
+    uploader.put(upload_path, MediaContainer(stream, 'image/jpeg', timestamp, timestamp_str))
 
 
-async def capture_video_and_upload(cam: PiCamera, delay: float, timeout: float,
-                                   uploader: MediaUploader, upload_path: Path, timestamp: datetime,
-                                   **kwargs):
+async def capture_video_and_upload(cam: PiCamera, executor: Executor, settings: dict, delay: float, timeout: float,
+                                   uploader: MediaUploader, upload_path: str, timestamp: datetime,
+                                   timestamp_str: str, **kwargs):
     """Capture a video and upload"""
-    stream = await capture_video(cam, delay, timeout, 'h264', **kwargs)
-    uploader.put(upload_path, MediaContainer(stream, 'video/H264', timestamp, float(cam.framerate)))
+    stream = await capture_video(cam, executor, settings, delay, timeout, 'h264', **kwargs)
+    uploader.put(upload_path, MediaContainer(stream, 'video/mp4', timestamp, timestamp_str))
+
+
+def h264_options(cfg: SimpleNamespace, framerate: float) -> dict:
+    """Encoder options for H.264 recordings"""
+    # Emit SPS/PPS with every key frame, which defaults to one per second, so that
+    # any segment of a recording can be decoded on its own.
+    return {
+        'profile': cfg.profile,
+        'level': '4.2',
+        'bitrate': cfg.bitrate,
+        'quality': cfg.quality,
+        'inline_headers': True,
+        'sps_timing': True,
+        'intra_period': cfg.intra_period if cfg.intra_period is not None else max(1, round(framerate)),
+    }
+
+
+def json_response(data, status: int = 200) -> web.Response:
+    """Like web.json_response, but serialized by orjson"""
+    return web.Response(body=orjson.dumps(data), status=status, content_type='application/json')
 
 
 def error_response(error: Exception, msg: Optional[str] = None, code: int = 500):
     if not msg:
         msg = str(error)
-    return web.json_response({'msg': msg, 'type': type(error).__name__, 'code': code}, status=code)
+    return json_response({'msg': msg, 'type': type(error).__name__, 'code': code}, status=code)
 
 
-def assert_camera_idle(f):
-    def inner(request: web.Request):
-        cam: PiCamera = request.config_dict['camera']
-        if cam.recording:
-            return error_response(PiCameraAlreadyRecording('The camera is busy.'), code=429)
-        return f(request)
+# Routes which can only be served while the camera is idle
+_CAMERA_IDLE_ROUTES = frozenset(('capture', 'update_camera_settings'))
+
 
-    return inner
+@web.middleware
+async def camera_idle_middleware(request: web.Request, handler):
+    """Reject requests to routes which need an idle camera while it is recording"""
+    config = request.config_dict
+    name = request.match_info.route.name
+    if name in _CAMERA_IDLE_ROUTES:
+        # A session holds the camera even before its recording has started
+        busy = config['camera'].recording or config['session_manager'].has_session
+        # Pending captures have already been set up with the current settings, e.g. ffmpeg with the frame rate
+        if name == 'update_camera_settings':
+            busy = busy or bool(config['capture_tasks'])
+        if busy:
+            return error_response(PiCameraAlreadyRecording('The camera is busy.'), code=429)
+    return await handler(request)
 
 
 routes = web.RouteTableDef()
@@ -81,66 +152,61 @@ routes = web.RouteTableDef()
 async def handle_get_camera(request: web.Request):
     """Retrieve whether the camera is recording"""
     cam: PiCamera = request.config_dict['camera']
-    return web.json_response({'recording': cam.recording})
+    return json_response({'recording': cam.recording})
 
 
-@routes.post('/camera')
-@assert_camera_idle
+@routes.post('/camera', name='capture')
 async def handle_post_camera(request: web.Request):
     """Create asynchronous capturing and uploading tasks"""
     config = request.config_dict
     cam: PiCamera = config['camera']
+    executor: Executor = config['capture_executor']
     uploader: MediaUploader = config['uploader']
-    module_id: str = config['module_id']
+    make_upload_path = config['make_upload_path']
+    settings: dict = config['camera_settings']
+    cfg: SimpleNamespace = config['cfg']
     try:
-        # Parse request body
-        params = await request.json()
-        uid = int(params['uid'])
-        entry_datetime = str(params['entry_datetime'])
-        assert entry_datetime.isdigit(), "'entry_datetime' should be the form of 'YYYYmmddHHMMSS'"
-        delay = float(params.get('delay', config['delay']))
-        timeout = float(params.get('timeout', config['timeout']))
-        mode = params.get('mode', 'video')
+        # Parse and validate request body. Numeric strings are still accepted for numbers.
+        params = msgspec.json.decode(await request.read(), type=CaptureParams, strict=False)
+        uid = params.uid
+        entry_datetime = str(params.entry_datetime)
+        assert _ENTRY_DATETIME.fullmatch(entry_datetime), "'entry_datetime' should be the form of 'YYYYmmddHHMMSS'"
+        delay = cfg.delay if params.delay is None else params.delay
+        timeout = cfg.timeout if params.timeout is None else params.timeout
+        mode = params.mode
 
         # Create a capturing task
         timestamp = datetime.now()
-        upload_path = Path(f'{uid}/{entry_datetime}/{module_id}-{timestamp:%Y%m%d%H%M%S}')
+        timestamp_str = timestamp.strftime(TIMESTAMP_FORMAT)
         if mode == 'image':
-            upload_path = upload_path.with_suffix('.jpg')
-            coro = capture_image_and_upload(cam, delay, uploader, upload_path, timestamp)
-        elif mode == 'video':
-            upload_path = upload_path.with_suffix('.mp4')
-            coro = capture_video_and_upload(cam, delay, timeout, uploader, upload_path, timestamp,
-                                            level='4.2', bitrate=config['bitrate'], quality=config['quality'])
+            upload_path = make_upload_path(uid, entry_datetime, timestamp_str, '.jpg')
+            coro = capture_image_and_upload(cam, executor, settings, delay, uploader, upload_path, timestamp,
+                                            timestamp_str)
         else:
-            raise ValueError(f"Unknown 'mode': {mode}. should be either 'image' or 'video'.")
-    except KeyError as e:
-        return error_response(e, f'A required key {e} is missing.', 400)
+            upload_path = make_upload_path(uid, entry_datetime, timestamp_str, '.mp4')
+            coro = capture_video_and_upload(cam, executor, settings, delay, timeout, uploader, upload_path,
+                                            timestamp, timestamp_str, **h264_options(cfg, settings['framerate']))
+    except (msgspec.DecodeError, AssertionError) as e:
+        return error_response(e, code=400)
     except Exception as e:
         return error_response(e)
 
-    # Run the task asyncly
-    asyncio.create_task(coro)
+    # Run the task asyncly. It is kept track of until done, which also keeps it from being garbage collected.
+    capture_tasks: set = config['capture_tasks']
+    task = asyncio.create_task(coro)
+    capture_tasks.add(task)
+    task.add_done_callback(capture_tasks.discard)
 
-    return web.json_response({'uri': urljoin(config['upload_root'], str(upload_path))})
+    return json_response({'uri': f'{cfg.upload_base}{upload_path}'})
 
 
 @routes.get('/camera/settings')
 async def handle_get_camera_settings(request: web.Request):
     """Retrieve camera settings"""
-    cam: PiCamera = request.config_dict['camera']
-    width, height = cam.resolution
-    return web.json_response({
-        'width': width,
-        'height': height,
-        'framerate': float(cam.framerate),
-        'rotation': cam.rotation,
-        'exposure_mode': cam.exposure_mode,
-    })
-
-
-@routes.put('/camera/settings')
-@assert_camera_idle
+    return json_response(request.config_dict['camera_settings'])
+
+
+@routes.put('/camera/settings', name='update_camera_settings')
 async def handle_put_camera_settings(request: web.Request):
     """Update camera settings"""
     # Back up original settings
@@ -150,17 +216,13 @@ async def handle_put_camera_settings(request: web.Request):
     _rotation = cam.rotation
     _exposure_mode = cam.exposure_mode
     try:
-        settings = await request.json()
-        assert isinstance(settings['width'], int) and 640 <= settings['width'] <= 3280
-        assert isinstance(settings['height'], int) and 480 <= settings['height'] <= 2464
-        assert 0 <= settings['framerate'] <= 90
-        assert isinstance(settings['rotation'], int) and settings['rotation'] in [0, 90, 180, 270]
-        assert settings['exposure_mode'] in PiCamera.EXPOSURE_MODES.keys()
-
-        cam.resolution = settings['width'], settings['height']
-        cam.framerate = settings['framerate']
-        cam.rotation = settings['rotation']
-        cam.exposure_mode = settings['exposure_mode']
+        settings = msgspec.json.decode(await request.read(), type=CameraSettings)
+        assert settings.exposure_mode in _EXPOSURE_MODES
+
+        cam.resolution = settings.width, settings.height
+        cam.framerate = settings.framerate
+        cam.rotation = settings.rotation
+        cam.exposure_mode = settings.exposure_mode
     except Exception as e:
         cam.resolution = _resolution
         cam.framerate = _framerate
@@ -168,6 +230,9 @@ async def handle_put_camera_settings(request: web.Request):
         cam.exposure_mode = _exposure_mode
         return error_response(e, code=400)
 
+    # Keep the cached settings in step with the camera
+    request.config_dict['camera_settings'].update(msgspec.structs.asdict(settings))
+
     return await handle_get_camera_settings(request)
 
 
@@ -177,31 +242,33 @@ async def handle_get_session(request: web.Request):
     config = request.config_dict
     cam: PiCamera = config['camera']
     session_manager: SessionManager = config['session_manager']
+    cfg: SimpleNamespace = config['cfg']
     try:
         cmd = request.query['cmd']
         if cmd == 'enter':
             # Parse request queries
             uid = int(request.query['uid'])
             entry_datetime = request.query['entry_datetime']
-            assert entry_datetime.isdigit(), "'entry_datetime' should be the form of 'YYYYmmddHHMMSS'"
-            capture_interval = float(request.query.get('capture_interval', config['capture_interval']))
+            assert _ENTRY_DATETIME.fullmatch(entry_datetime), "'entry_datetime' should be the form of 'YYYYmmddHHMMSS'"
+            capture_interval = float(request.query.get('capture_interval', cfg.capture_interval))
 
             # Create a new session
-            session = session_manager.create(cam, uid, entry_datetime)
-            session.start(capture_interval, 'jpeg', 'h264',
-                          level='4.2', bitrate=config['bitrate'], quality=config['quality'])
-            return web.json_response({'session': str(session)}, status=201)
+            session = session_manager.create(cam, config['capture_executor'], uid, entry_datetime)
+            settings: dict = config['camera_settings']
+            await session.start(settings, capture_interval, 'jpeg', 'h264',
+                                **h264_options(cfg, settings['framerate']))
+            return json_response({'session': str(session)}, status=201)
         elif cmd == 'exit':
             # Destroy the running session and upload recorded items
             session, path_list = await session_manager.destroy(upload=True)
-            return web.json_response({
+            return json_response({
                 'session': str(session),
-                'uri_list': [urljoin(config['upload_root'], str(p)) for p in path_list]
+                'uri_list': [f'{cfg.upload_base}{p}' for p in path_list]
             })
         elif cmd == 'interrupt':
             # Abort any running session
             session, _ = await session_manager.destroy(upload=False)
-            return web.json_response({'session': str(session)})
+            return json_response({'session': str(session)})
         else:
             raise ValueError(f"Unknown cmd={cmd}. should be one of [enter, exit, interrupt].")
     except KeyError as e:
@@ -220,5 +287,5 @@ async def handle_get_session(request: web.Request):
     raise web.HTTPInternalServerError()
 
 
-api_v1 = web.Application()
+api_v1 = web.Application(middlewares=[camera_idle_middleware])
 api_v1.add_routes(routes)
@@ -1,9 +1,17 @@
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import os
+from queue import SimpleQueue
+import socket
+from types import SimpleNamespace
+from urllib.parse import urljoin
 
-from aiohttp import web
+from aiohttp import ClientSession, TCPConnector, web
 from picamera import PiCamera
+import uvloop
 
 from api_v1 import api_v1
 from session import SessionManager
@@ -18,17 +26,24 @@ parser.add_argument('-rot', '--rotation', default=0, type=int, choices=[0, 90, 1
 parser.add_argument('-em', '--exposure-mode', default='sports', choices=PiCamera.EXPOSURE_MODES.keys(),
                     help='set the exposure mode')
 parser.add_argument('-b', '--bitrate', default=6000000, type=int, help='set bitrate')
+parser.add_argument('-p', '--profile', default='high', choices=['baseline', 'main', 'high', 'constrained'],
+                    help='set the H.264 profile')
+parser.add_argument('-ip', '--intra-period', default=None, type=int,
+                    help='set the key frame rate (defaults to one key frame per second)')
 parser.add_argument('-q', '--quality', default=23, type=int,
                     help='the quality that the encoder should attempt to maintain')
 parser.add_argument('-d', '--delay', default=0.0, type=float, help='default delay before recording (in second)')
 parser.add_argument('-t', '--timeout', default=5.0, type=float, help='default time to capture for (in second)')
 parser.add_argument('-st', '--session-timeout', default=300.0, type=float,
                     help='default period of time before interrupting session (in seconds)')
+parser.add_argument('-sm', '--session-memory', default=64, type=int,
+                    help='memory for images captured during a session, beyond which they are spooled to disk (in MiB)')
 parser.add_argument('-ci', '--capture-interval', default=5.0, type=float,
                     help='default image capture interval during a session (in seconds)')
 parser.add_argument('--upload-endpoint', default='')
 parser.add_argument('--upload-root', default='')
 parser.add_argument('--token', default='')
+parser.add_argument('--upload-workers', default=4, type=int, help='number of concurrent uploads')
 parser.add_argument('--module-id', default='01')
 parser.add_argument('--request-port', default=8080, type=int, help='port to listen capture requests')
 parser.add_argument('--debug', action='store_true', help='enable debug mode')
@@ -46,7 +61,12 @@ for k, v in opt.__dict__.items():
     print(f'  {k!s}={v!r}')
 print('=' * 40 + '\n')
 
-logging.basicConfig(level=logging.DEBUG if opt.debug else logging.INFO)
+# Log records are only queued on the calling thread and written out by a background thread,
+# so that a slow stderr never stalls the event loop.
+log_queue = SimpleQueue()
+logging.basicConfig(level=logging.DEBUG if opt.debug else logging.INFO, handlers=[QueueHandler(log_queue)])
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
 
 
 async def initialize(app: web.Application):
@@ -57,26 +77,55 @@ async def initialize(app: web.Application):
     cam.rotation = opt.rotation
     cam.exposure_mode = opt.exposure_mode
     app['camera'] = cam
+    # Current camera settings, so that reading them doesn't have to query the camera
+    app['camera_settings'] = {
+        'width': opt.width,
+        'height': opt.height,
+        'framerate': float(opt.framerate),
+        'rotation': opt.rotation,
+        'exposure_mode': opt.exposure_mode,
+    }
+    # Blocking camera calls run here, one at a time, to keep the event loop responsive
+    app['capture_executor'] = ThreadPoolExecutor(max_workers=1, thread_name_prefix='camera')
+    # One-shot capture tasks which haven't finished yet
+    app['capture_tasks'] = set()
+    # HTTP client session kept alive for the whole lifetime of the app
+    # One pooled connection per upload worker, resolved over IPv4 only and cached for long
+    connector = TCPConnector(limit=opt.upload_workers, limit_per_host=opt.upload_workers, keepalive_timeout=120,
+                             ttl_dns_cache=600, family=socket.AF_INET)
+    app['http_session'] = ClientSession(connector=connector)
     # Item uploader
-    uploader = MediaUploader(opt.upload_endpoint, opt.token)
+    uploader = MediaUploader(opt.upload_endpoint, opt.token, app['http_session'], opt.upload_workers)
     app['uploader'] = uploader
+    # Upload path of a captured item
+    module_id = opt.module_id
+
+    def make_upload_path(uid: int, sid: str, timestamp_str: str, ext: str) -> str:
+        return f'{uid}/{sid}/{module_id}-{timestamp_str}{ext}'
+
+    app['make_upload_path'] = make_upload_path
     # One and only session manager
-    path_fmt = f'{{uid}}/{{sid}}/{opt.module_id}-{{timestamp:%Y%m%d%H%M%S}}{{ext}}'
-    app['session_manager'] = SessionManager(opt.session_timeout, uploader, path_fmt)
-    # Settings
-    app['bitrate'] = opt.bitrate
-    app['quality'] = opt.quality
-    app['delay'] = opt.delay
-    app['timeout'] = opt.timeout
-    app['capture_interval'] = opt.capture_interval
-    app['upload_endpoint'] = opt.upload_endpoint
-    app['upload_root'] = opt.upload_root
-    app['module_id'] = opt.module_id
+    app['session_manager'] = SessionManager(opt.session_timeout, uploader, make_upload_path,
+                                            opt.session_memory * 1024 * 1024)
+    # Settings, fixed for the lifetime of the app
+    app['cfg'] = SimpleNamespace(
+        profile=opt.profile,
+        intra_period=opt.intra_period,
+        bitrate=opt.bitrate,
+        quality=opt.quality,
+        delay=opt.delay,
+        timeout=opt.timeout,
+        capture_interval=opt.capture_interval,
+        # Resolved once, so that joining a path onto it is a plain concatenation
+        upload_base=urljoin(opt.upload_root, '.') if opt.upload_root else '',
+    )
 
 
 async def cleanup(app):
     await app['session_manager'].destroy_silently()
     await app['uploader'].dispose()
+    await app['http_session'].close()
+    app['capture_executor'].shutdown()
     app['camera'].close()
 
 
@@ -85,4 +134,10 @@ app.on_startup.append(initialize)
 app.on_cleanup.append(cleanup)
 app.add_subapp('/v1/', api_v1)
 
-web.run_app(app, port=opt.request_port)
+# libuv-based event loop, a drop-in replacement for the default one
+asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+try:
+    web.run_app(app, port=opt.request_port)
+finally:
+    # Write out any records still queued, even if the app failed
+    log_listener.stop()
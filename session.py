@@ -1,13 +1,26 @@
 import asyncio
-from datetime import datetime
-from pathlib import Path
+from concurrent.futures import Executor
+from contextlib import suppress
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from io import BytesIO
 from tempfile import TemporaryFile
-from time import timezone
-from typing import Optional, NoReturn, List, Tuple
+import time
+from typing import Optional, NoReturn, List, Tuple, Callable, BinaryIO
 
 from picamera import PiCamera, PiCameraAlreadyRecording, PiCameraNotRecording
 
-from util import Event, MediaContainer, Singleton, log, bytes_for_humans, MediaUploader
+from util import (Event, MediaContainer, Singleton, log, bytes_for_humans, MediaUploader, preallocated_stream,
+                  TIMESTAMP_FORMAT)
+
+# Local timezone to properly print timestamps, resolved once for all sessions
+_LOCAL_TZ = timezone(timedelta(seconds=-time.timezone))
+# File extensions of uploaded items. Raw videos are containerized into MP4 by the uploader.
+_EXT_BY_MIMETYPE = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'video/h264': '.mp4',
+}
 
 
 class SessionAlreadyExists(Exception):
@@ -30,29 +43,41 @@ class SessionInvalidError(Exception):
 
 
 class Session:
-    def __init__(self, camera: PiCamera, uid: int, sid: str) -> NoReturn:
+    def __init__(self, camera: PiCamera, executor: Executor, uid: int, sid: str,
+                 memory_budget: int = 64 * 1024 * 1024) -> NoReturn:
         # Indicate the status of this session
         self._in_progress = False
         self._disposed = False
 
         self._cam = camera
+        # Blocking camera calls run on this executor
+        self._executor = executor
         self._uid = uid
         self._sid = sid
 
-        self._raw_stream = TemporaryFile()
+        # Unbuffered, since the encoder writes whole frames at a time and ffmpeg reads the file by its descriptor
+        self._raw_stream = TemporaryFile(buffering=0)
         self._items = []
+        # Images are kept in memory up to this many bytes in total, and spooled to disk beyond
+        self._memory_budget = memory_budget
+        self._memory_used = 0
 
         self._task_image_capture = None
+        # Whether start_recording has returned, so that a failed start can be undone
+        self._recording_started = False
         self._started_at = None
         self._video_mime_type = None
         self._image_mime_type = None
+        # Camera settings can't change while recording, so they are read once at the start
+        self._framerate = None
+        self._image_size_hint = None
+
+        # Held while starting or stopping, so that a stop waits for the start to finish
+        self._lock = asyncio.Lock()
 
         self.on_stopping = Event()  # Invoked just before stopping
         self.on_disposed = Event()  # Invoked after fully disposed
 
-        # Get local timezone to properly print timestamps
-        self._tz = datetime.timezone(datetime.timedelta(seconds=-timezone))
-
     def __str__(self) -> str:
         return f"Session(" \
                f"uid={self._uid}, sid='{self._sid}', " \
@@ -66,35 +91,67 @@ class Session:
     def sid(self) -> str:
         return self._sid
 
-    def start(self,
-              image_capture_interval: float, image_format: str = 'jpeg',
-              video_format: str = 'h264', **kwargs) -> NoReturn:
+    async def start(self, camera_settings: dict,
+                    image_capture_interval: float, image_format: str = 'jpeg',
+                    video_format: str = 'h264', **kwargs) -> NoReturn:
         """Start a new session."""
         log.info(f'{self}: Attemping to start a new session...')
-        if self._disposed:
-            log.error(f'{self} is already been disposed!')
-            raise SessionInvalidError
-        if self._in_progress:
-            log.error(f'{self} is already in progress.')
-            raise PiCameraAlreadyRecording
+        async with self._lock:
+            if self._disposed:
+                log.error(f'{self} is already been disposed!')
+                raise SessionInvalidError
+            if self._in_progress:
+                log.error(f'{self} is already in progress.')
+                raise PiCameraAlreadyRecording
+            # In progress from here on, so that nothing else takes the camera while recording starts
+            self._in_progress = True
+            try:
+                await self._start(camera_settings, image_capture_interval, image_format, video_format, **kwargs)
+            except BaseException:
+                # Failed to start. Release the camera, since this session is of no use anymore.
+                self._in_progress = False
+                if self._recording_started:
+                    with suppress(PiCameraNotRecording):
+                        await asyncio.get_running_loop().run_in_executor(self._executor, self._cam.stop_recording)
+                await self.dispose()
+                raise
+        log.info(f'{self}: Session has started.')
+
+    async def _start(self, camera_settings: dict,
+                     image_capture_interval: float, image_format: str, video_format: str, **kwargs) -> NoReturn:
+        # One byte per pixel is generous enough for the buffer of a JPEG never to grow
+        self._image_size_hint = camera_settings['width'] * camera_settings['height']
+        self._framerate = camera_settings['framerate']
         # Start recording a video
-        self._video_mime_type = f'video/{video_format.upper()}'
-        self._started_at = datetime.datetime.now(self._tz)
-        self._cam.start_recording(self._raw_stream, video_format, **kwargs)
+        self._video_mime_type = f'video/{video_format.lower()}'
+        self._started_at = datetime.now(_LOCAL_TZ)
+        # Camera calls block for a while, so they run on the camera executor
+        loop = asyncio.get_running_loop()
+        recording = loop.run_in_executor(
+            self._executor, partial(self._cam.start_recording, self._raw_stream, video_format, **kwargs))
+        try:
+            # The executor call can't be called off, so see it through even if cancelled
+            await asyncio.shield(recording)
+        finally:
+            if not recording.done():
+                await asyncio.wait([recording])
+            self._recording_started = not recording.cancelled() and recording.exception() is None
         # Check if any error occured
-        self._cam.wait_recording(0)
+        await loop.run_in_executor(self._executor, self._cam.wait_recording, 0)
         log.debug(f'Video recording started at {self._started_at.isoformat()}. (MIME type: {self._video_mime_type})')
 
         # Start continuous captures
-        self._image_mime_type = f'image/{image_format}'
+        self._image_mime_type = f'image/{image_format.lower()}'
         self._task_image_capture = asyncio.create_task(self._capture_images(image_capture_interval, image_format))
         log.debug(f'Continuous image capturing started. (MIME type: {self._image_mime_type})')
 
-        self._in_progress = True
-        log.info(f'{self}: Session has started.')
-
     async def stop(self) -> List[MediaContainer]:
         """Stop recording and return items"""
+        # Wait for the session to finish starting, if it still is
+        async with self._lock:
+            return await self._stop()
+
+    async def _stop(self) -> List[MediaContainer]:
         log.info(f'{self}: Attempting to stop...')
         if self._disposed:
             log.error(f'{self} is already been disposed!')
@@ -106,7 +163,7 @@ class Session:
         await self.on_stopping()
 
         # Stop video recording
-        self._cam.stop_recording()
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._cam.stop_recording)
         log.debug(f'Video recording stopped.')
 
         # Stop image capturing
@@ -122,7 +179,8 @@ class Session:
                 self._raw_stream,
                 self._video_mime_type,
                 self._started_at,
-                float(self._cam.framerate))
+                self._started_at.strftime(TIMESTAMP_FORMAT),
+                self._framerate)
         )
 
         self._in_progress = False
@@ -130,32 +188,43 @@ class Session:
 
         return self._items
 
-    async def _capture_image_on_event(self, event: asyncio.Event, image_format: str) -> NoReturn:
+    def _new_image_stream(self) -> BinaryIO:
+        """Return a stream to capture an image into, in memory as long as the budget allows"""
+        size = self._image_size_hint
+        if self._memory_used + size <= self._memory_budget:
+            return preallocated_stream(size)
+        return TemporaryFile()
+
+    async def _capture_images(self, interval: float, image_format: str) -> NoReturn:
+        loop = asyncio.get_running_loop()
         try:
+            # Tick on a fixed schedule, so that time spent on each capture doesn't add up to drift
+            deadline = loop.time()
             while True:
-                await event.wait()
-                stream = TemporaryFile()
-                self._cam.capture(stream, image_format, use_video_port=True)
-                timestamp = datetime.datetime.now(self._tz)
+                stream = self._new_image_stream()
+                # Stills get a splitter port of their own, apart from the recording on port 1
+                await loop.run_in_executor(
+                    self._executor,
+                    partial(self._cam.capture, stream, image_format, use_video_port=True, splitter_port=2))
+                timestamp = datetime.now(_LOCAL_TZ)
                 filesize = stream.tell()
+                if isinstance(stream, BytesIO):
+                    stream.truncate(filesize)
+                    self._memory_used += filesize
                 stream.seek(0)
-                self._items.append(MediaContainer(stream, self._image_mime_type, timestamp))
+                self._items.append(
+                    MediaContainer(stream, self._image_mime_type, timestamp, timestamp.strftime(TIMESTAMP_FORMAT)))
                 log.debug(f'New image captured at {timestamp.isoformat()}. ({bytes_for_humans(filesize)})')
-                event.clear()
-        except asyncio.CancelledError:
-            pass
 
-    async def _capture_images(self, interval: float, image_format: str) -> NoReturn:
-        event = asyncio.Event()
-        task = asyncio.create_task(self._capture_image_on_event(event, image_format))
-        try:
-            while True:
-                event.set()
-                await asyncio.sleep(interval)
+                deadline += interval
+                delay = deadline - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    # Fallen behind schedule. Skip the missed ticks instead of catching up in a burst.
+                    deadline = loop.time()
         except asyncio.CancelledError:
-            log.debug('Cancel signal received. Gracefully stopping continous image capturing...')
-            task.cancel()
-            await task
+            log.debug('Cancel signal received. Continuous image capturing stopped.')
 
     @property
     def is_running(self) -> bool:
@@ -175,73 +244,77 @@ class Session:
 
 
 class SessionManager(metaclass=Singleton):
-    def __init__(self, session_timeout: float, uploader: MediaUploader, path_fmt: str) -> NoReturn:
+    def __init__(self, session_timeout: float, uploader: MediaUploader,
+                 make_upload_path: Callable[[int, str, str, str], str],
+                 memory_budget: int) -> NoReturn:
         self.__instance: Optional[Session] = None
         self._lock: asyncio.Lock = asyncio.Lock()
         self._timeout: float = session_timeout
-        self._task_watchdog: Optional[asyncio.Task] = None
+        self._timeout_handle: Optional[asyncio.TimerHandle] = None
+        self._task_timeout: Optional[asyncio.Task] = None
         self._uploader: MediaUploader = uploader
-        self._path_fmt: str = path_fmt
+        self._make_upload_path = make_upload_path
+        self._memory_budget: int = memory_budget
 
     async def _empty_session(self) -> NoReturn:
         self.__instance = None
 
-    async def _timeout_watchdog(self) -> NoReturn:
-        log.debug(f'Timeout watchdog initialized. Automatically destroy the session in {self._timeout} seconds')
+    def _on_timeout(self) -> NoReturn:
+        # Timed out. No coming back.
+        self._timeout_handle = None
+        self._task_timeout = asyncio.create_task(self._destroy_on_timeout())
+
+    async def _destroy_on_timeout(self) -> NoReturn:
         try:
-            await asyncio.sleep(self._timeout)
-            # Watchdog invoked. No coming back.
-            self.__instance.on_stopping.detach(self._cancel_watchdog)
             await self.destroy(True)
-            log.warning('Watchdog invoked. The session has been destroyed.')
+            log.warning('Session timed out. The session has been destroyed.')
         except SessionNotExists:
-            log.warning("Watchdog invoked. But the session doesn't exist. Skipping...")
-        except asyncio.CancelledError:
-            log.debug('Watchdog cancelled.')
+            log.warning("Session timed out. But the session doesn't exist. Skipping...")
+        except Exception as e:
+            # Nothing awaits this task, so report the error here
+            log.error(f'Session timed out. But failed to destroy the session: {e!r}')
 
-    async def _cancel_watchdog(self) -> NoReturn:
-        if self._task_watchdog:
-            self._task_watchdog.cancel()
-            await self._task_watchdog
-            self._task_watchdog = None
+    async def _cancel_timeout(self) -> NoReturn:
+        if self._timeout_handle:
+            self._timeout_handle.cancel()
+            self._timeout_handle = None
 
     def create(self, *args, **kwargs) -> Session:
         if self.__instance:
             raise SessionAlreadyExists('A session can only exist only one at any given time.')
-        self.__instance = Session(*args, **kwargs)
-        self.__instance.on_stopping.attach(self._cancel_watchdog)
+        self.__instance = Session(*args, memory_budget=self._memory_budget, **kwargs)
+        self.__instance.on_stopping.attach(self._cancel_timeout)
         self.__instance.on_disposed.attach(self._empty_session)
-        self._task_watchdog = asyncio.create_task(self._timeout_watchdog())
+        # A session which failed to start is disposed without stopping
+        self.__instance.on_disposed.attach(self._cancel_timeout)
+        # Automatically destroy the session once it times out
+        self._timeout_handle = asyncio.get_running_loop().call_later(self._timeout, self._on_timeout)
+        log.debug(f'Automatically destroy the session in {self._timeout} seconds')
         return self.__instance
 
-    async def destroy(self, upload: bool = True) -> Tuple[Session, List[Path]]:
+    async def destroy(self, upload: bool = True) -> Tuple[Session, List[str]]:
         async with self._lock:
             session = self.__instance
             if not session:
                 raise SessionNotExists
-            items = await self.__instance.stop()
+            try:
+                items = await session.stop()
+            except SessionInvalidError:
+                # The session failed to start and has been disposed meanwhile
+                raise SessionNotExists
 
         path_list = []
         if upload:
             # Upload items
-            fmt = self._path_fmt
             for item in items:
                 # Determine a file extension based on its mimetype
-                ext = ''
-                if item.mimetype.startswith('image/'):
-                    subtype = item.mimetype[6:].lower()
-                    if subtype == 'jpeg':
-                        ext = '.jpg'
-                    elif subtype == 'png':
-                        ext = '.png'
-                elif item.mimetype.startswith('video/'):
-                    ext = '.mp4'
+                ext = _EXT_BY_MIMETYPE.get(item.mimetype, '')
 
                 # Check if ext is set
                 if not ext:
                     log.warning('ext is not set!')
 
-                upload_path = Path(fmt.format(uid=session.uid, sid=session.sid, timestamp=item.timestamp, ext=ext))
+                upload_path = self._make_upload_path(session.uid, session.sid, item.timestamp_str, ext)
                 path_list.append(upload_path)
                 # Put the item in the uploader's queue
                 self._uploader.put(upload_path, item)
@@ -254,6 +327,10 @@ class SessionManager(metaclass=Singleton):
         except SessionNotExists:
             pass
 
+    @property
+    def has_session(self) -> bool:
+        return self.__instance is not None
+
     @property
     def session(self) -> Session:
         if not self.__instance:
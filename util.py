@@ -1,154 +1,383 @@
 import asyncio
+import fcntl
 import logging
+import os
 from datetime import datetime
-from io import BytesIO
-from pathlib import Path
-from tempfile import TemporaryFile
-from typing import NamedTuple, Optional, NoReturn, BinaryIO, Tuple, Iterable, Union
+from io import BytesIO, UnsupportedOperation
+from typing import AsyncIterator, NamedTuple, Optional, NoReturn, BinaryIO, Tuple, Iterable, Union, List
 
-from aiohttp import ClientSession, FormData
+from aiohttp import ClientSession, MultipartWriter
+from aiohttp.payload import BytesPayload, Payload, StringPayload, get_payload
 
 log = logging.getLogger('playz-module-camera')
 
+# Size of chunks in which media are streamed
+CHUNK_SIZE = 64 * 1024
+# Capacity requested for pipes to and from ffmpeg. Linux allows up to 1 MiB for unprivileged processes.
+PIPE_SIZE = 1024 * 1024
+# Upper bound on memory committed up front for an output buffer of unknown size
+MAX_PREALLOCATED_SIZE = 32 * 1024 * 1024
+# Exposed by fcntl only since Python 3.10
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+# ffmpeg options for fragmented MP4, which can be written to a pipe
+MP4_STREAMING_OPTIONS = ('-movflags', '+frag_keyframe+empty_moov+default_base_moof')
+# Format of timestamps in upload paths
+TIMESTAMP_FORMAT = '%Y%m%d%H%M%S'
+# Amount of the most recent ffmpeg error output which is kept for logging
+STDERR_TAIL_SIZE = 4096
+
 
 class Singleton(type):
     _instances = {}
 
     def __call__(cls, *args, **kwargs):
-        if cls not in cls._instances:
-            cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
-        else:
-            cls._instances[cls].__init__(*args, **kwargs)
-        return cls._instances[cls]
+        # Later calls return the existing instance as is. Initializing it again would leak its tasks.
+        instance = cls._instances.get(cls)
+        if instance is None:
+            instance = cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
+        return instance
 
 
 class Event:
     def __init__(self):
-        self._handlers = []
+        # Handlers are the keys. Bound methods are equal and hash alike as long as they wrap the same method,
+        # so a handler can be detached by looking it up again.
+        self._handlers = {}
 
     def attach(self, handler) -> NoReturn:
-        self._handlers.append(handler)
+        self._handlers[handler] = None
 
     def detach(self, handler) -> NoReturn:
-        self._handlers.remove(handler)
+        self._handlers.pop(handler, None)
 
     async def __call__(self, *args, **kwargs) -> NoReturn:
-        for handler in self._handlers:
-            await handler(*args, **kwargs)
+        # Handlers run concurrently, over a snapshot so that they may attach or detach handlers themselves
+        await asyncio.gather(*(handler(*args, **kwargs) for handler in tuple(self._handlers)))
 
 
-async def containerize_raw_video(raw_stream: Union[BinaryIO, BytesIO],
-                                 framerate: float,
-                                 fmt: str,
-                                 extra_options: Optional[Iterable[str]] = None,
-                                 ffmpeg_bin: str = 'ffmpeg') -> BinaryIO:
-    video = TemporaryFile()
+def enlarge_pipe(fd: int, size: int = PIPE_SIZE) -> NoReturn:
+    """Grow the capacity of a pipe, so that bulk transfers through it take fewer syscalls"""
+    try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except OSError as e:
+        log.debug(f'Failed to enlarge a pipe: {e}')
+
+
+# Leading ffmpeg options, the same for every run
+_FFMPEG_GLOBAL_OPTIONS = (
+    '-hide_banner',
+    '-loglevel', 'error',
+    # Raw streams carry no timestamps; generate them from the frame rate
+    '-fflags', '+genpts',
+)
+
+
+def ffmpeg_command(framerate: float,
+                   fmt: str,
+                   extra_options: Optional[Iterable[str]] = None,
+                   input_fmt: str = 'h264',
+                   ffmpeg_bin: str = 'ffmpeg') -> List[str]:
+    """Build a command line which remuxes a raw video from stdin to stdout"""
     cmd = [
         ffmpeg_bin,
-        '-hide_banner',
-        '-loglevel', 'error',
-        '-framerate', f'{framerate}',
+        *_FFMPEG_GLOBAL_OPTIONS,
+        '-r', f'{framerate}',
+        # Name the input format explicitly so that ffmpeg doesn't have to probe for it
+        '-f', input_fmt,
         '-i', '-',
-        '-an',
-        '-c:v', 'copy',
+        '-c', 'copy',
         '-f', fmt
     ]
     if extra_options:
         cmd.extend(extra_options)
-    cmd.extend(['-'])
+    cmd.append('-')
+    return cmd
+
+
+async def read_tail(stream: asyncio.StreamReader, size: int = STDERR_TAIL_SIZE) -> bytes:
+    """Read a stream to the end, keeping only its last `size` bytes"""
+    tail = bytearray()
+    while True:
+        chunk = await stream.read(size)
+        if not chunk:
+            return bytes(tail)
+        tail += chunk
+        del tail[:-size]
 
-    bytesio_input = isinstance(raw_stream, BytesIO)
 
+async def _reap_ffmpeg(proc: asyncio.subprocess.Process, task_stderr: asyncio.Task, report: bool = True) -> int:
+    """Wait for ffmpeg to exit, logging its errors unless told not to report them"""
+    err, = await asyncio.gather(task_stderr, return_exceptions=True)
+    returncode = await proc.wait()
+    if isinstance(err, BaseException):
+        log.error(f'FFmpeg exited with {returncode}. Failed to read its errors: {err!r}')
+    elif report and (returncode or err):
+        log.error(f'FFmpeg exited with {returncode}: {err.decode(errors="replace")}')
+    return returncode
+
+
+async def containerize_raw_video(raw_stream: BinaryIO,
+                                 framerate: float,
+                                 fmt: str,
+                                 extra_options: Optional[Iterable[str]] = None,
+                                 input_fmt: str = 'h264',
+                                 ffmpeg_bin: str = 'ffmpeg') -> AsyncIterator[bytes]:
+    """
+    Containerize a raw video, yielding the output of ffmpeg in chunks as it comes.
+
+    Nothing is written to disk, so `fmt` has to be writable to a pipe, e.g. MP4 with MP4_STREAMING_OPTIONS.
+    """
+    cmd = ffmpeg_command(framerate, fmt, extra_options, input_fmt, ffmpeg_bin)
+
+    # The raw video is a file on disk, which ffmpeg reads straight from its descriptor
     proc = await asyncio.create_subprocess_exec(
         *cmd,
-        stdin=raw_stream if not bytesio_input else asyncio.subprocess.PIPE,
-        stdout=video,
-        stderr=asyncio.subprocess.PIPE
+        stdin=raw_stream,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=PIPE_SIZE
     )
+    task_stderr = asyncio.create_task(read_tail(proc.stderr))
+
+    try:
+        while True:
+            chunk = await proc.stdout.read(PIPE_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        abandoned = proc.returncode is None and not proc.stdout.at_eof()
+        if abandoned:
+            # Not read to the end, e.g. the upload failed
+            proc.kill()
+        await _reap_ffmpeg(proc, task_stderr, report=not abandoned)
+
+
+class LiveContainerizer:
+    """
+    A writable sink which containerizes a raw video while it is being recorded.
+
+    Everything written is piped straight into ffmpeg, so the raw video is never buffered,
+    and the output of ffmpeg is collected in memory as it comes.
+    `write()` may be called from any thread, e.g. the encoder thread of picamera.
+    """
+
+    def __init__(self, proc: asyncio.subprocess.Process, sink: BinaryIO, video: BytesIO) -> NoReturn:
+        self._proc = proc
+        self._sink = sink
+        self._video = video
+        self._task_drain = asyncio.create_task(self._drain())
+        # stderr is consumed while recording too, so that ffmpeg never blocks on a full pipe
+        self._task_stderr = asyncio.create_task(read_tail(proc.stderr))
+
+    @classmethod
+    async def open(cls,
+                   framerate: float,
+                   fmt: str,
+                   extra_options: Optional[Iterable[str]] = None,
+                   input_fmt: str = 'h264',
+                   expected_size: int = 0,
+                   ffmpeg_bin: str = 'ffmpeg') -> 'LiveContainerizer':
+        """Spawn ffmpeg and return a sink connected to its stdin"""
+        cmd = ffmpeg_command(framerate, fmt, extra_options, input_fmt, ffmpeg_bin)
+        # Allocated up front, so that running out of memory leaves no ffmpeg behind.
+        # Only a bounded amount is committed; the buffer grows beyond it as needed.
+        video = preallocated_stream(min(expected_size, MAX_PREALLOCATED_SIZE))
+        read_fd, write_fd = os.pipe()
+        enlarge_pipe(write_fd)
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=read_fd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                limit=PIPE_SIZE
+            )
+        except Exception:
+            os.close(write_fd)
+            raise
+        finally:
+            os.close(read_fd)
+        return cls(proc, open(write_fd, 'wb'), video)
 
-    if bytesio_input:
-        proc.stdin.write(raw_stream.getvalue())
-        proc.stdin.close()
+    async def _drain(self) -> NoReturn:
+        while True:
+            chunk = await self._proc.stdout.read(PIPE_SIZE)
+            if not chunk:
+                break
+            self._video.write(chunk)
 
-    # Wait for process to terminate
-    _, err = await proc.communicate()
-    if err:
-        log.error(f'FFmpeg error: {err.decode()}')
+    def write(self, b) -> int:
+        return self._sink.write(b)
 
-    video.seek(0)
-    # Issue: aiohttp FormData serializer doesn't detect TemporaryFileWrapper(NamedTemporaryFile) as IOBase.
-    return video
+    def flush(self) -> NoReturn:
+        self._sink.flush()
+
+    async def close(self) -> BytesIO:
+        """Finish the stream and return the containerized video"""
+        try:
+            self._sink.close()
+        except BaseException:
+            # Flushing fails with BrokenPipeError once ffmpeg has died
+            if self._proc.returncode is None:
+                self._proc.kill()
+            raise
+        finally:
+            # Always reap ffmpeg and the tasks reading from it
+            await asyncio.gather(self._task_drain, return_exceptions=True)
+            await _reap_ffmpeg(self._proc, self._task_stderr)
+
+        self._video.truncate(self._video.tell())
+        self._video.seek(0)
+        return self._video
+
+
+def preallocated_stream(size: int) -> BytesIO:
+    """Create a BytesIO whose buffer is grown to `size` bytes up front.
+
+    Writes up to that size don't reallocate the buffer. Truncate the stream at its
+    position once writing is done to drop the unused tail.
+    """
+    stream = BytesIO()
+    if size > 0:
+        stream.seek(size - 1)
+        stream.write(b'\0')
+        stream.seek(0)
+    return stream
+
+
+def file_size(file: BinaryIO) -> int:
+    """Get the size of a file object and rewind it"""
+    try:
+        # A single stat call for files on disk
+        size = os.fstat(file.fileno()).st_size
+    except (AttributeError, UnsupportedOperation):
+        # In-memory streams have no file descriptor
+        file.seek(0, 2)
+        size = file.tell()
+    file.seek(0)
+    return size
+
+
+_UNITS = ('B', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB', 'YB')
 
 
 def bytes_for_humans(n: int) -> str:
-    for unit in ['B', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB']:
-        if n < 1024.0:
-            return f'{n:.1f}{unit}'
-        n /= 1024.0
-    return f'{n:.1f}YB'
+    # Every unit is 2^10 times the previous one, so the bit length of n tells the unit
+    idx = min((n.bit_length() - 1) // 10, len(_UNITS) - 1) if n > 0 else 0
+    return f'{n / (1 << (idx * 10)):.1f}{_UNITS[idx]}'
 
 
 class MediaContainer(NamedTuple):
     file: BinaryIO
     mimetype: str
     timestamp: datetime
+    # Formatted with TIMESTAMP_FORMAT once at capture, for upload paths
+    timestamp_str: str
     framerate: Optional[float] = None
 
 
-class MediaUploader(metaclass=Singleton):
-    def __init__(self, upload_endpoint: str, token: str, workers: int = 4) -> NoReturn:
-        self._upload_endpoint = upload_endpoint
-        self._token = token
+class BufferPayload(Payload):
+    """
+    Payload of an in-memory stream, sent in chunks sliced from a memoryview over its buffer.
 
-        # Create worker tasks to process the queue concurrently.
-        self._tasks = [asyncio.create_task(self._worker(f'worker-{i}')) for i in range(workers)]
-        self._q: "asyncio.Queue[Tuple[Path, MediaContainer]]" = asyncio.Queue()
+    Unlike BytesIOPayload, no chunk is copied out of the buffer.
+    """
 
-    def put(self, upload_path: Path, item: MediaContainer) -> NoReturn:
+    def __init__(self, value: BytesIO, *args, **kwargs) -> NoReturn:
+        super().__init__(value, *args, **kwargs)
+        self._size = value.getbuffer().nbytes
+
+    def decode(self, encoding: str = 'utf-8', errors: str = 'strict') -> str:
+        return self._value.getvalue().decode(encoding, errors)
+
+    async def write(self, writer) -> NoReturn:
+        with self._value.getbuffer() as view:
+            for offset in range(0, len(view), CHUNK_SIZE):
+                await writer.write(view[offset:offset + CHUNK_SIZE])
+
+
+class MediaUploader(metaclass=Singleton):
+    def __init__(self, upload_endpoint: str, token: str, session: ClientSession, workers: int = 4) -> NoReturn:
+        self._upload_endpoint = upload_endpoint
+        # The token part is the same for every request, so it's built only once.
+        self._token_part = BytesPayload(token.encode(), content_type='text/plain; charset=utf-8')
+        self._token_part.set_content_disposition('form-data', name='token')
+        # Shared among uploads so that they reuse pooled keep-alive connections.
+        self._session = session
+
+        # A single dispatcher starts an upload per item, as long as fewer than `workers` are running.
+        self._q: "asyncio.Queue[Tuple[str, MediaContainer]]" = asyncio.Queue()
+        self._slots = asyncio.Semaphore(workers)
+        self._uploads = set()
+        self._task_dispatch = asyncio.create_task(self._dispatch())
+
+    def put(self, upload_path: str, item: MediaContainer) -> NoReturn:
         self._q.put_nowait((upload_path, item))
 
+    def _build_form(self,
+                    upload_path: str,
+                    file: Union[BinaryIO, AsyncIterator[bytes]],
+                    mimetype: str) -> MultipartWriter:
+        form = MultipartWriter('form-data')
+        form.append_payload(self._token_part)
+        # Prepend "/" to path
+        path_part = StringPayload(f'/{upload_path}')
+        path_part.set_content_disposition('form-data', name='upload_path')
+        form.append_payload(path_part)
+        if isinstance(file, BytesIO):
+            upload_part = BufferPayload(file, content_type=mimetype)
+        else:
+            upload_part = get_payload(file, content_type=mimetype)
+        upload_part.set_content_disposition('form-data', name='upload', filename=upload_path.rpartition('/')[2])
+        form.append_payload(upload_part)
+        return form
+
     async def dispose(self) -> NoReturn:
         # Wait until the queue is fully processed.
         await self._q.join()
 
-        # Cancel our worker tasks.
-        for task in self._tasks:
-            task.cancel()
-
-        # Wait until all worker tasks are cancelled.
-        await asyncio.gather(*self._tasks, return_exceptions=True)
-
-    async def _worker(self, name: str) -> NoReturn:
-        session = ClientSession()
+        # Cancel the dispatcher and wait until it is cancelled.
+        self._task_dispatch.cancel()
+        await asyncio.gather(self._task_dispatch, return_exceptions=True)
+
+    async def _dispatch(self) -> NoReturn:
+        while True:
+            # Get a work item out of the queue, once an upload slot is free.
+            upload_path, media = await self._q.get()
+            await self._slots.acquire()
+            task = asyncio.create_task(self._upload(upload_path, media))
+            # Keep a reference so that the running task isn't garbage collected
+            self._uploads.add(task)
+            task.add_done_callback(self._uploads.discard)
+
+    async def _upload(self, upload_path: str, media: MediaContainer) -> NoReturn:
+        video = None
         try:
-            while True:
-                # Get a work item out of the queue.
-                upload_path, media = await self._q.get()
-                file = media.file
-                mimetype = media.mimetype
-                framerate = media.framerate
-
-                if mimetype.startswith('video/'):
-                    # Convert to mp4
-                    file = await containerize_raw_video(file, framerate, 'mp4', ['-movflags', 'empty_moov'])
-
-                # Get the size of a file object
-                file.seek(0, 2)
-                filesize = file.tell()
-                file.seek(0)
-
-                form = FormData()
-                form.add_field('token', self._token)
-                # Prepend "/" to path
-                form.add_field('upload_path', f'/{upload_path}')
-                form.add_field('upload', file, content_type=mimetype, filename=upload_path.name)
-
-                log.info(f'{name}: upload_path: /{upload_path}, size: {bytes_for_humans(filesize)}')
-
-                async with session.post(self._upload_endpoint, data=form) as res:
-                    log.info(f'{name}: Response from the server: {repr(res)}, {await res.text()}')
-
-                # Notify the queue that the work item has been processed.
-                self._q.task_done()
+            file = media.file
+            mimetype = media.mimetype
+            framerate = media.framerate
+
+            if mimetype == 'video/h264':
+                # Convert to mp4, streamed into the request as ffmpeg produces it
+                file = video = containerize_raw_video(file, framerate, 'mp4', MP4_STREAMING_OPTIONS)
+                mimetype = 'video/mp4'
+                size = 'streamed'
+            else:
+                size = bytes_for_humans(file_size(file))
+
+            form = self._build_form(upload_path, file, mimetype)
+
+            log.info(f'upload_path: /{upload_path}, size: {size}')
+
+            async with self._session.post(self._upload_endpoint, data=form) as res:
+                log.info(f'/{upload_path}: Response from the server: {repr(res)}, {await res.text()}')
+        except Exception as e:
+            log.error(f'Failed to upload /{upload_path}: {e!r}')
         finally:
-            await session.close()
+            if video is not None:
+                # Make sure that ffmpeg is done with, even if the upload didn't read it to the end
+                await video.aclose()
+            self._slots.release()
+            # Notify the queue that the work item has been processed.
+            self._q.task_done()